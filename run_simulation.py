@@ -7,16 +7,30 @@ Ryan Meshulam and Lihao Xue, 2024
 Runs a ChampSim simulation and saves the results.
 """
 import argparse
+import hashlib
 import json
+import os
 import pathlib
+import random
 import subprocess
 import datetime
+import functools
+import multiprocessing
 import uuid
-from shutil import copyfile, rmtree
-from typing import List
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import re
+import select
 
 default_output_dir = "simulation-results"
+hash_buffer_size = 8 * 1024 * 1024
+default_checksum_cache = pathlib.Path("~/.champsim_sim_cache.json").expanduser()
+
+_BIN_DIR = pathlib.Path("bin").resolve()
+_UTC = datetime.timezone.utc
+
+_TRACE_NUM_RE = re.compile(r"^\d{3}")
+_TRACE_OFFSET_RE = re.compile(r"(?<=-)\d+(?=B\.champsimtrace)")
 
 
 def parse_arguments():
@@ -59,13 +73,13 @@ def parse_arguments():
         type=int,
         default=1
     )
-    """parser.add_argument(
-        "--daemonize",
-        "-d",
-        action="store_true",
+    parser.add_argument(
+        "--foreground",
+        "-f",
+        action="store_false",
         dest="daemonize",
-        help="Daemonize ChampSim and return immediately, or keep ChampSim running in the foreground. Will print the PID of the running process.",
-    )"""
+        help="Wait for each ChampSim process to finish instead of daemonizing it and returning immediately. Limits the number of concurrent simulations to the process pool size.",
+    )
     parser.add_argument(
         "--quiet",
         "-q",
@@ -100,7 +114,7 @@ def parse_arguments():
         "--tracelist",
         metavar="list_file.txt",
         required=False,
-        help="File containing a list of trace files to run. Cannot be used concurrently with --trace. Recommended to run with --daemonize.",
+        help="File containing a list of trace files to run. Cannot be used concurrently with --trace. Simulations are daemonized by default, so every line is launched at once; use --foreground to limit how many run concurrently.",
     )
 
     args = parser.parse_args()
@@ -112,23 +126,117 @@ def parse_arguments():
     return args
 
 
+def _utc_stamp() -> Tuple[str, str]:
+    # Read the clock once and return both the compact and the ISO 8601 form
+    now = datetime.datetime.now(_UTC)
+    return now.strftime("%Y-%m-%dT%H%M%SZ"), now.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+
 def create_directory(
-    output_dir: pathlib.Path, trace_num: int, instr_offset: int, binary_name: str, dry_run=False
+    output_dir: pathlib.Path, trace_num: int, instr_offset: int, binary_name: str, dry_run=False,
+    now_str: Optional[str] = None,
 ):
     # Create output directory
-    if not output_dir.exists():
-        output_dir.mkdir()
+    output_dir.mkdir(parents=True, exist_ok=True)
 
     # Get current datetime
-    now = datetime.datetime.now(datetime.timezone.utc)
-    now_str = now.isoformat(timespec="seconds").replace(":", "").replace("+0000", "Z")
+    if now_str is None:
+        now_str = _utc_stamp()[0]
 
-    # Construct results directory
+    # Construct results directory. Parallel simulations of the same trace can
+    # start within the same second, so claim a unique name with a retry suffix.
     results_dir = now_str + "_" + binary_name + "_" + str(trace_num) + "-" + str(instr_offset)
     results_path = output_dir / results_dir
-    if (not results_path.exists()) and (not dry_run):
-        results_path.mkdir()
-    return results_path
+    suffix = 0
+    while True:
+        if dry_run:
+            if not results_path.exists():
+                return results_path
+        else:
+            try:
+                results_path.mkdir()
+                return results_path
+            except FileExistsError:
+                pass
+        suffix += 1
+        results_path = output_dir / (results_dir + "_" + str(suffix))
+
+
+def _sha1_file(path: str) -> str:
+    # Hash in-process with a large read buffer rather than piping through sha1sum.
+    # hashlib.file_digest is not used: its buffer is fixed at 256 KiB.
+    with open(path, "rb", buffering=0) as f:
+        h = hashlib.sha1()
+        buf = bytearray(hash_buffer_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+        return h.hexdigest()
+
+
+def _load_checksum_cache(cache_path: pathlib.Path = default_checksum_cache) -> Dict[str, str]:
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _checksum_traces(
+    traces: Iterable[pathlib.Path],
+    executor: Optional[Executor] = None,
+    cache_path: pathlib.Path = default_checksum_cache,
+) -> Dict[pathlib.Path, str]:
+    # Traces are immutable, so a digest stays valid while size and mtime match.
+    # Each distinct trace is hashed at most once, and only on a cache miss.
+    cache = _load_checksum_cache(cache_path)
+    resolved = {trace: str(trace.resolve()) for trace in dict.fromkeys(traces)}
+    keys: Dict[str, str] = {}
+    for resolved_path in dict.fromkeys(resolved.values()):
+        st = os.stat(resolved_path)
+        keys[resolved_path] = resolved_path + "|" + str(st.st_size) + "|" + str(st.st_mtime_ns)
+
+    misses = [path for path, key in keys.items() if key not in cache]
+    if misses:
+        # Hash the misses in parallel on the pool when one is given
+        hash_map = executor.map if executor is not None else map
+        for path, digest in zip(misses, hash_map(_sha1_file, misses)):
+            cache[keys[path]] = digest
+
+        # Merge with entries saved by concurrent runs, then replace atomically
+        on_disk = _load_checksum_cache(cache_path)
+        on_disk.update(cache)
+        temp_cache_path = cache_path.with_name(cache_path.name + "." + str(os.getpid()) + ".tmp")
+        try:
+            with open(temp_cache_path, "w") as f:
+                json.dump(on_disk, f)
+            os.replace(temp_cache_path, cache_path)
+        except OSError:
+            pass
+
+    return {trace: cache[keys[resolved_path]] for trace, resolved_path in resolved.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def _git_commit() -> str:
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def _wait_pidfd(pid: int):
+    # Block until the process exits without polling, using a pidfd (Linux >= 5.3)
+    pidfd = os.pidfd_open(pid)
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        poller.poll()
+    finally:
+        os.close(pidfd)
+    return os.waitid(os.P_PID, pid, os.WEXITED)
 
 
 def run_simulation(
@@ -138,14 +246,26 @@ def run_simulation(
     run_id: str,
     daemonize: bool = True,
     quiet: bool = False,
+    trace_digests: Optional[Dict[pathlib.Path, str]] = None,
+    git_commit: Optional[str] = None,
+    cpu_set: Optional[Set[int]] = None,
+    sim_id: Optional[str] = None,
 ):
+    # Resolve each distinct trace once. A single trace replicated across cores
+    # is resolved only once.
+    resolved_by_trace = {trace: str(trace.resolve()) for trace in dict.fromkeys(trace_path)}
+    resolved = [resolved_by_trace[trace] for trace in trace_path]
+
     first_trace_filename = trace_path[0].name
-    first_trace_num = int(re.match(r"^\d{3}", first_trace_filename).group(0))
-    first_trace_instr_offset = int(re.search(r"(?<=-)\d+(?=B\.champsimtrace)", first_trace_filename).group(0))
+    first_trace_num = int(_TRACE_NUM_RE.match(first_trace_filename).group(0))
+    first_trace_instr_offset = int(_TRACE_OFFSET_RE.search(first_trace_filename).group(0))
+
+    now_str, now_iso = _utc_stamp()
 
     # Create output directory
     results_path = create_directory(
-        output_dir=output_dir, trace_num=first_trace_num, instr_offset=first_trace_instr_offset, binary_name=binary_name)
+        output_dir=output_dir, trace_num=first_trace_num, instr_offset=first_trace_instr_offset, binary_name=binary_name,
+        now_str=now_str)
 
     if not quiet:
         print(
@@ -155,57 +275,76 @@ def run_simulation(
 
     # Generate run command
     cmd = [
-        str((pathlib.Path("bin")/binary_name).resolve())
+        str(_BIN_DIR / binary_name)
     ]
 
     # Add the trace files to the command
     cmd.append("-traces")
-    for trace in trace_path:
-        cmd.append(str(trace.resolve()))
+    cmd.extend(resolved)
 
     if not quiet:
         print("Command: " + str(cmd))
 
-    # Compute checksum of the trace files
-    trace_checksums: List[str] = []
-    for trace in trace_path:
-        trace_checksums.append(
-            subprocess.run(
-                ["sha1sum", str(trace)], capture_output=True, text=True, check=True
-            ).stdout.strip()
-        )
+    # Compute checksum of the trace files, formatted like sha1sum output
+    if trace_digests is None:
+        trace_digests = _checksum_traces(trace_path)
+    trace_checksums: List[str] = [
+        trace_digests[trace] + "  " + str(trace) for trace in trace_path
+    ]
 
     # Get current git commit
-    git_commit = subprocess.run(
-        ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
-    ).stdout.strip()
+    if git_commit is None:
+        git_commit = _git_commit()
 
-    # Save the run metadata to a file
-    with open(results_path / "run_metadata.json", "w") as f:
-        json.dump(
+    # Save the run metadata to a file, serialized up front so it is written at once
+    (results_path / "run_metadata.json").write_text(
+        json.dumps(
             {
                 "trace_path": [str(trace) for trace in trace_path],
                 "trace_checksum": trace_checksums,
                 "git_commit": git_commit,
                 "binary_name": binary_name,
                 "run_id": run_id,
-                "sim_id": uuid.uuid4().hex,
-                "run_datetime": datetime.datetime.now(datetime.timezone.utc).isoformat(
-                    timespec="seconds"
-                ),
+                "sim_id": sim_id if sim_id is not None else uuid.uuid4().hex,
+                "run_datetime": now_iso,
                 "command": str(cmd),
-            },
-            f,
+            }
         )
+    )
 
     # Run the simulation
 
-    with open(results_path / "sim_output.log", "wb") as sim_output_file:
+    # ChampSim writes straight to this descriptor, so skip Python-side buffering
+    sim_output_fd = os.open(
+        results_path / "sim_output.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+    )
+    with open(sim_output_fd, "wb", buffering=0) as sim_output_file:
+        # Own session so a Ctrl-C on the launcher does not kill running simulations
+        sim_process = subprocess.Popen(
+            cmd,
+            stdout=sim_output_file,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            start_new_session=True,
+        )
+        if cpu_set is not None:
+            # Pin after launch rather than in preexec_fn, which is not fork-safe.
+            # ChampSim starts unpinned for the moment before this call; a failed
+            # pin leaves it to the OS scheduler, which is only a performance loss.
+            try:
+                os.sched_setaffinity(sim_process.pid, cpu_set)
+            except OSError as e:
+                if not quiet:
+                    print(
+                        "Could not pin ChampSim (PID "
+                        + str(sim_process.pid)
+                        + ") to CPUs "
+                        + str(sorted(cpu_set))
+                        + ": "
+                        + str(e)
+                    )
         if daemonize:
             # Run in the background
-            sim_process = subprocess.Popen(
-                cmd, stdout=sim_output_file, stderr=subprocess.STDOUT, text=True
-            )
             if not quiet:
                 print(
                     "ChampSim running in the background with PID "
@@ -215,17 +354,93 @@ def run_simulation(
                 print("PID: " + str(sim_process.pid))
             return
         else:
-            # Does not work right now!
             # Run in the foreground
-            """
-            sim_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+            try:
+                status = _wait_pidfd(sim_process.pid)
+                sim_process.returncode = (
+                    status.si_status
+                    if status.si_code == os.CLD_EXITED
+                    else -status.si_status
+                )
+            except (AttributeError, OSError):
+                # No pidfd support on this kernel or Python
+                sim_process.wait()
             if not quiet:
-                for line in iter(sim_process.stdout.readline, ''):
-                    print(line, end='')
-                    stdout_file.write(line)"""
+                print(
+                    "ChampSim exited with code "
+                    + str(sim_process.returncode)
+                    + ". Output saved at "
+                    + str((results_path / "sim_output.log").absolute().resolve())
+                )
             return
 
 
+def _expand_tracepath(traces: List[str], num_cores: int) -> List[pathlib.Path]:
+    tracepath = [pathlib.Path(trace) for trace in traces]
+
+    # Validate that the number of traces is equal to the number of cores or one
+    if len(tracepath) != 1 and len(tracepath) != num_cores:
+        print(tracepath)
+        raise ValueError(
+            "The number of traces must be equal to the number of cores or one."
+        )
+
+    # If the number of traces is one, then we need to duplicate the trace for each core
+    if len(tracepath) == 1:
+        tracepath *= num_cores
+    return tracepath
+
+
+def _read_tracelist(tracelist_file: str, num_cores: int) -> List[List[pathlib.Path]]:
+    # Read and validate every line up front so a bad tracelist fails before
+    # ChampSim is built or any simulation is launched
+    tracepaths: List[List[pathlib.Path]] = []
+    num_traces = None
+    with open(tracelist_file, "r") as f:
+        for traceline in f:
+            traces = traceline.strip(", \n").split(",")
+            if traces == [""]:
+                continue
+            if num_traces is None:
+                num_traces = len(traces)
+            elif len(traces) != num_traces:
+                raise ValueError(
+                    "Each line in the tracelist file must have the same number of traces."
+                )
+            tracepaths.append(_expand_tracepath(traces, num_cores))
+    return tracepaths
+
+
+def _partition_cpus(num_cores: int) -> List[Optional[Set[int]]]:
+    # Split the CPUs we may run on into disjoint groups of num_cores, one per
+    # concurrently running (foreground) simulation
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * max(1, (os.cpu_count() or 1) // num_cores)
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < num_cores:
+        return [set(cpus)]
+    return [
+        set(cpus[i:i + num_cores])
+        for i in range(0, len(cpus) - num_cores + 1, num_cores)
+    ]
+
+
+# CPU set owned by this pool worker for its whole lifetime (foreground runs only)
+_worker_cpu_set: Optional[Set[int]] = None
+
+
+def _init_worker(cpu_set_queue):
+    # Each worker takes one set, and the pool has one worker per set, so
+    # simulations running at the same time never share CPUs
+    global _worker_cpu_set
+    _worker_cpu_set = cpu_set_queue.get()
+
+
+def _run_one(kwargs: dict):
+    # Module-level so it can be pickled and handed to a worker process
+    return run_simulation(cpu_set=_worker_cpu_set, **kwargs)
+
+
 def main():
     args = parse_arguments()
     # print(args)
@@ -233,48 +448,22 @@ def main():
     # tracelist is a list of lists of traces, where each list of traces should
     # be the same length and should correspond to the number of cores, or one
     if args.tracelist is not None:
-        # Determine if we're running multiple tests or just one
-        with open(args.tracelist, "r") as f:
-            tracelines = f.read().splitlines()
-        tracelist: List[List[str]] = [
-            traceline.strip(", \n").split(",") for traceline in tracelines
-        ]
-        for trace in tracelist:
-            if len(trace) != len(tracelist[0]):
-                raise ValueError(
-                    "Each line in the tracelist file must have the same number of traces."
-                )
+        tracepaths = _read_tracelist(args.tracelist, args.cores)
     else:
-        tracelist: List[List[str]] = [args.trace]
-
-    tracepaths = [[pathlib.Path(trace) for trace in traces] for traces in tracelist]
-    # print(tracepaths)
+        tracepaths = [_expand_tracepath(args.trace, args.cores)]
 
     # Generate a unique ID for this run
     run_id: str = uuid.uuid4().hex
+    # Per-simulation IDs come from one seeded generator instead of a getrandom() each
+    sim_id_rng = random.Random(os.urandom(16))
+    git_commit = _git_commit()
 
     binary_name = args.predictor + "-" + args.l1d + "-" + args.l2c + "-" + args.llc_replacement + "-" + str(args.cores) + "core"
-    
-    # Validate that the number of traces is equal to the number of cores or one
-    if (len(tracepaths[0]) != 1 and len(tracepaths[0]) != args.cores):
-        print("len(tracepaths): ", str(len(tracepaths)))
-        print(tracepaths)
-        raise ValueError(
-            "The number of traces must be equal to the number of cores or one."
-        )
-    
-    # If the number of traces is one, then we need to duplicate the trace for each core
-    if (len(tracepaths[0]) == 1 and args.cores > 1):
-        for i in range(len(tracepaths)):
-            for j in range(args.cores - 1):
-                tracepaths[i].append(tracepaths[i][0])
-    
-    # print(tracepaths)
 
     output_dir = pathlib.Path(args.output)
 
     # Configure and make ChampSim
-    if (not (pathlib.Path("bin") / binary_name).exists()) or args.force_build:
+    if (not (_BIN_DIR / binary_name).exists()) or args.force_build:
         build_process = subprocess.run(
             ["./build_champsim.sh", args.predictor, args.l1d, args.l2c, args.llc_replacement, str(args.cores)],
             capture_output=True,
@@ -288,14 +477,41 @@ def main():
             print(build_process.stderr)
             print("\n")
 
-    # Run the simulations
-    for tracepath in tracepaths:
-        run_simulation(
-            trace_path=tracepath,
-            binary_name=binary_name,
-            output_dir=output_dir,
-            run_id=run_id,
+    # Run the simulations in parallel. A ChampSim process simulates all of its
+    # cores on a single thread, but budget one host CPU per simulated core so
+    # that concurrent runs do not oversubscribe the machine. In the foreground,
+    # each pool worker owns one CPU set for its lifetime, so simulations that
+    # run at the same time are pinned to disjoint CPUs. Daemonized workers
+    # return as soon as ChampSim is launched, so those runs are left unpinned.
+    cpu_sets = _partition_cpus(args.cores)
+    pool_options = {}
+    if not args.daemonize:
+        cpu_set_queue = multiprocessing.Queue()
+        for cpu_set in cpu_sets:
+            cpu_set_queue.put(cpu_set)
+        pool_options = dict(initializer=_init_worker, initargs=(cpu_set_queue,))
+    with ProcessPoolExecutor(max_workers=len(cpu_sets), **pool_options) as executor:
+        # Checksum every distinct trace once up front, reusing digests saved by
+        # previous runs, so each simulation only receives the digests it needs
+        trace_digests = _checksum_traces(
+            (trace for tracepath in tracepaths for trace in tracepath), executor
+        )
+
+        sim_kwargs = (
+            dict(
+                trace_path=tracepath,
+                binary_name=binary_name,
+                output_dir=output_dir,
+                run_id=run_id,
+                daemonize=args.daemonize,
+                quiet=args.quiet,
+                trace_digests={trace: trace_digests[trace] for trace in tracepath},
+                git_commit=git_commit,
+                sim_id="%032x" % sim_id_rng.getrandbits(128),
+            )
+            for tracepath in tracepaths
         )
+        list(executor.map(_run_one, sim_kwargs))
 
 
 if __name__ == "__main__":